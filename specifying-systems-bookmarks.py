@@ -32,11 +32,45 @@ jump to the contents. Only clicking in the bookmarks view in e.g. Preview.app's
 sidebar will navigate to the proper location.
 """
 import argparse
+import locale
+import mmap
 import os
 import re
 import sys
-from dataclasses import dataclass
-from subprocess import check_call, check_output
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from subprocess import PIPE, CalledProcessError, Popen, check_output, run
+
+# Patterns used to parse pdftocgen's output, compiled once at import time.
+# The output is processed as bytes; titles are decoded only once they're
+# yielded as bookmarks, with the locale encoding that pdftocgen printed them in
+# and that text-mode pipes and files use to encode them again.
+_TOC_ENCODING = locale.getpreferredencoding(False)
+_PART_RE = re.compile(rb'Part (\w+)')
+_CHAPTER_RE = re.compile(rb'Chapter \d+')
+_SECTION_RE = re.compile(rb'(\d+)\.(\d+)\s+(\w+)')
+
+# pdftocgen lines that aren't bookmarks, like the running head.
+_SKIP_TITLES = frozenset({b'Specifying Systems'})
+
+# Pieces of the temporary PDF's structure needed to append an incremental
+# update to it.
+_OBJECT_HEADER_RE = re.compile(rb'(\d+)\s+(\d+)\s+obj\s*\Z')
+_TRAILER_SIZE_RE = re.compile(rb'/Size\s+(\d+)')
+_TRAILER_INFO_RE = re.compile(rb'/Info\s+\d+\s+\d+\s+R')
+_TRAILER_ID_RE = re.compile(rb'/ID\s*\[[^\]]*\]')
+
+# Leading whitespace for each bookmark level in pdftocio's TOC format, and a
+# bound formatter for a whole TOC line.
+_INDENTS = tuple(' ' * 4 * level for level in range(8))
+_FORMAT_TOC_LINE = '{}"{}" {} {}\n'.format
+
+
+def run_pdfxmeta(input_pdf, pageno, level, pattern):
+    return check_output(
+        ['pdfxmeta', '-p', str(pageno), '-a', str(level), input_pdf, pattern],
+        text=True)
+
 
 parser = argparse.ArgumentParser(sys.argv[0],
                                  description=__doc__.split('\n')[0])
@@ -51,53 +85,93 @@ output_pdf = f'{os.path.splitext(args.input_pdf)[0]}_out.pdf'
 # attributes of those strings, so we can find all similar such strings and
 # consider them headings. The levels don't work (chapters, sections, etc. have
 # the same font in "Specifying Systems") so we'll process them further below.
-with open('recipe.toml', 'w+') as recipe_file:
-    # Create the recipe.
-    for pageno, level, pattern in [
-        (9, 1, "Contents"),
-        (23, 2, "Part I"),
-        (23, 3, "Getting Started"),
-        (27, 4, "A Little Simple Math"),
-        (27, 5, "Propositional Logic"),
-    ]:
-        output = check_output(
-            ['pdfxmeta', '-p', str(pageno), '-a', str(level), args.input_pdf,
-             pattern], text=True)
-        recipe_file.write(output)
-        recipe_file.write('\n')
+#
+# Each pdfxmeta run is independent and mostly spent opening the PDF, so run
+# them concurrently and write their output in the original order.
+recipe_headings = [
+    (9, 1, "Contents"),
+    (23, 2, "Part I"),
+    (23, 3, "Getting Started"),
+    (27, 4, "A Little Simple Math"),
+    (27, 5, "Propositional Logic"),
+]
 
-# Create the raw Table Of Contents (TOC). Since different heading levels in
-# "Specifying Systems" aren't sufficiently distinguished by font, we'll have to
-# do some more munging.
-toc_raw = check_output(['pdftocgen', '-v', '-r', 'recipe.toml', args.input_pdf],
-                       text=True)
+# The recipe only depends on the input PDF and the headings above. Record them
+# in a comment on the recipe's first line and skip pdfxmeta if an existing
+# recipe.toml was made from the same, unmodified PDF.
+input_stat = os.stat(args.input_pdf)
+recipe_key = (f'# {os.path.abspath(args.input_pdf)} {input_stat.st_size} '
+              f'{input_stat.st_mtime_ns} {recipe_headings!r}\n')
+
+try:
+    with open('recipe.toml') as recipe_file:
+        recipe_is_current = recipe_file.readline() == recipe_key
+except FileNotFoundError:
+    recipe_is_current = False
+
+if not recipe_is_current:
+    # Write to a temporary file so an interrupted run can't leave a partial
+    # recipe that looks current.
+    with open('recipe.toml.tmp', 'w') as recipe_file, \
+            ThreadPoolExecutor(max_workers=len(recipe_headings)) as executor:
+        # Create the recipe.
+        recipe_file.write(recipe_key)
+        for output in executor.map(
+                partial(run_pdfxmeta, args.input_pdf),
+                *zip(*recipe_headings)):
+            recipe_file.write(output)
+            recipe_file.write('\n')
+
+    os.replace('recipe.toml.tmp', 'recipe.toml')
 
 
-@dataclass
 class TOCLine:
-    title: str
-    page: int
-    vertical_position: float
-    level: int = 0
+    # Not a dataclass: slots=True needs Python 3.10, and there's one of these
+    # per TOC line.
+    __slots__ = ('title', 'page', 'vertical_position', 'level')
+
+    def __init__(self, title, page, vertical_position, level=0):
+        self.title = title
+        self.page = page
+        self.vertical_position = vertical_position
+        self.level = level
 
     def to_toc_line(self):
-        spaces = ' ' * 4 * self.level
-        return f'{spaces}"{self.title}" {self.page} {self.vertical_position}'
+        return _FORMAT_TOC_LINE(_INDENTS[self.level], self.title, self.page,
+                                self.vertical_position)
+
 
+def parse_toc_line(line_text):
+    """Parse a pdftocgen line like b'    "1.2 Sets" 31 123.4'."""
+    rest = line_text.lstrip()
+    if not rest.startswith(b'"'):
+        raise ValueError(f'Unexpected TOC line: {line_text!r}')
 
-def gen_bookmarks():
+    # Titles may themselves contain quotes; the page and position never do.
+    end = rest.rindex(b'"')
+    page, vertical_position = rest[end + 1:].split()
+    return TOCLine(title=rest[1:end],
+                   page=int(page),
+                   vertical_position=float(vertical_position))
+
+
+def gen_bookmarks(toc_raw):
     buffer = None
+    # Bind the per-line helpers to locals once rather than looking them up as
+    # globals on every line.
+    parse_line = parse_toc_line
+    match_part = _PART_RE.match
+    match_chapter = _CHAPTER_RE.match
+    search_section = _SECTION_RE.search
+    skip_titles = _SKIP_TITLES
 
-    for line_text in toc_raw.split('\n'):
+    for line_text in toc_raw:
         if not line_text.strip():
             continue
 
-        line_match = re.match(r'(\s*)"(.*?)" (\d+) ([\d.]+)', line_text)
-        line = TOCLine(title=line_match.group(2),
-                       page=int(line_match.group(3)),
-                       vertical_position=float(line_match.group(4)))
+        line = parse_line(line_text)
 
-        if line.title == 'Specifying Systems':
+        if line.title in skip_titles:
             continue
 
         # In "Specifying Systems", a part/chapter begins like:
@@ -105,75 +179,192 @@ def gen_bookmarks():
         #           Part I
         #       Getting Started
         #
-        # pdftocgen makes 2 lines in toc_raw, so we'll first see "Part I" and
+        # pdftocgen makes 2 lines in its output, so we'll first see "Part I" and
         # then "Getting Started". Buffer the first line, add it to the second to
         # produce a bookmark titled "Part I - Getting Started".
-        if title_match := re.search(r'Part (\w+)', line.title):
+        #
+        # Most lines are ordinary titles. Parts, chapters, and sections start
+        # with different characters ('P', 'C', or a digit), so dispatch on the
+        # first character and only run a regex when it could match.
+        title = line.title
+        first = title[:1]
+        if (first == b'P' and title.startswith(b'Part ')
+                and (title_match := match_part(title))):
             buffer = title_match.group(0)
-        elif title_match := re.search(r'Chapter \d+', line.title):
+        elif (first == b'C' and title.startswith(b'Chapter ')
+                and (title_match := match_chapter(title))):
             buffer = title_match.group(0)
-        elif re.search(r'(\d+)\.(\d+)\s+(\w+)', line.title):
+        elif first.isdigit() and search_section(title):
             # This is a section like "1.2 Sets".
             assert buffer is None
+            line.title = title.decode(_TOC_ENCODING)
             line.level = 2
             yield line
         elif buffer:
             # If buffer starts with 'Part' then this is top-level, else it's
             # 'Chapter' and this is level 1.
-            line.level = 0 if buffer.startswith('Part') else 1
-            line.title = f'{buffer} - {line.title}'
+            line.level = 0 if buffer.startswith(b'Part') else 1
+            line.title = (buffer + b' - ' + title).decode(_TOC_ENCODING)
             buffer = None
             yield line
         else:
             # Not part, chapter, or section header. Accept default level 0.
+            line.title = title.decode(_TOC_ENCODING)
             yield line
 
 
-with open('toc.tmp', 'w+') as toc_file:
+# Create the raw Table Of Contents (TOC). Since different heading levels in
+# "Specifying Systems" aren't sufficiently distinguished by font, we'll have to
+# do some more munging. Process pdftocgen's output line by line as it arrives
+# rather than waiting for the whole TOC.
+with Popen(['pdftocgen', '-v', '-r', 'recipe.toml', args.input_pdf],
+           stdout=PIPE) as toc_proc:
     introduction_page = None
-    for toc_line in gen_bookmarks():
+    toc_lines = []
+    for toc_line in gen_bookmarks(toc_proc.stdout):
         if toc_line.title == "Introduction":
             # We'll use this below.
             introduction_page = toc_line.page
 
-        toc_file.write(toc_line.to_toc_line() + '\n')
+        toc_lines.append(toc_line.to_toc_line())
+
+if toc_proc.returncode:
+    raise CalledProcessError(toc_proc.returncode, toc_proc.args)
 
+# pdftocio reads the TOC from stdin if it's not given a file.
 tmp_pdf = f'{os.path.splitext(args.input_pdf)[0]}_tmp.pdf'
-check_call(['pdftocio', args.input_pdf, '-t', 'toc.tmp', '-o', tmp_pdf])
+run(['pdftocio', args.input_pdf, '-o', tmp_pdf],
+    input=''.join(toc_lines), text=True, check=True)
 
 # The first 18 pages of "Specifying Systems" are Roman-numeraled, and page 1
 # starts around the 19th. Note this in PDF metadata so apps' "jump to page"
 # feature works.
-assert introduction_page is not None, "Couldn't find 'Introduction' page"
-
-with open(tmp_pdf, 'rb') as tmp_file:
-    output_bytes = tmp_file.read()
-
-with open(output_pdf, 'wb+') as output_file:
-    # The output PDF has one Catalog entry like:
-    # <</Type/Catalog/Pages 1412 0 R/Outlines 1415 0 R>>
-    # Add /PageLabels before /Outlines.
-    n_catalogs = 0
-
-    def replace_catalog(match):
-        global n_catalogs
-        n_catalogs += 1
-        catalog_start = match.group(1).decode('ascii')
-        catalog_end = match.group(2).decode('ascii')
-        for catalog_part in catalog_start, catalog_end:
-            assert '/PageLabels' not in catalog_part, \
-                f'PDF already has PageLabels in Category: {catalog_part}'
-
-        return (
-            f'''<<{catalog_start}''' 
-            f'''/PageLabels'''
-            f'''<</Nums[0 << /S /r >> {introduction_page - 1} << /S /D >>]>>''' 
-            f'''{catalog_end}>>'''.encode('ascii'))
-
-    output_file.write(re.sub(
-        rb'<<([\s\n]*/Type[\s\n]*/Catalog.*)(/Outlines.*)>>',
-        replace_catalog, output_bytes, flags=re.MULTILINE))
-    assert n_catalogs > 0, f"Couldn't find /Catalog in {output_pdf}"
-    assert n_catalogs == 1, f"Too many catalog entries in {output_pdf}"
+# These checks guard the output PDF, so they're explicit rather than asserts
+# that "python -O" would strip.
+if introduction_page is None:
+    raise RuntimeError("Couldn't find 'Introduction' page")
+
+
+def find_dict_end(pdf_bytes, start):
+    """Return the offset just past the '>>' closing the '<<' at start."""
+    # Dictionaries nest, e.g. /Names<</Dests 7 0 R>> in a catalog, so count
+    # '<<' and '>>' to find the one that closes this dictionary.
+    depth = 1
+    end = start + 2
+    while depth:
+        next_open = pdf_bytes.find(b'<<', end)
+        next_close = pdf_bytes.find(b'>>', end)
+        if next_close == -1:
+            raise RuntimeError(f"Unterminated dictionary in {tmp_pdf}")
+        if next_open != -1 and next_open < next_close:
+            depth += 1
+            end = next_open + 2
+        else:
+            depth -= 1
+            end = next_close + 2
+
+    return end
+
+
+def find_catalog(pdf_bytes):
+    """Find the catalog dictionary, which must contain /Outlines.
+
+    Returns the offsets of its opening '<<', its '/Outlines' key, and the end of
+    its closing '>>'.
+    """
+    type_catalog = pdf_bytes.find(b'/Catalog')
+    if type_catalog == -1:
+        raise RuntimeError(f"Couldn't find /Catalog in {tmp_pdf}")
+    if pdf_bytes.find(b'/Catalog', type_catalog + 1) != -1:
+        raise RuntimeError(f"Too many catalog entries in {tmp_pdf}")
+
+    start = pdf_bytes.rfind(b'<<', 0, type_catalog)
+    if (start == -1
+            or pdf_bytes[start + 2:type_catalog].split() != [b'/Type']):
+        raise RuntimeError(f"Malformed /Catalog in {tmp_pdf}")
+
+    end = find_dict_end(pdf_bytes, start)
+    outlines = pdf_bytes.find(b'/Outlines', type_catalog, end)
+    if outlines == -1:
+        raise RuntimeError(f"No /Outlines in {tmp_pdf}")
+    return start, outlines, end
+
+
+def find_trailer(pdf_bytes):
+    """Return the offset of the last xref section and its trailer dictionary."""
+    startxref = pdf_bytes.rfind(b'startxref')
+    if startxref == -1:
+        raise RuntimeError(f"Couldn't find startxref in {tmp_pdf}")
+    xref = int(pdf_bytes[startxref + 9:startxref + 40].split()[0])
+
+    # We append a classic xref table, which can't follow a cross-reference
+    # stream. pdftocio saves with a classic table, so this shouldn't happen.
+    if pdf_bytes[xref:xref + 4] != b'xref':
+        raise RuntimeError(f"{tmp_pdf} uses a cross-reference stream")
+
+    trailer = pdf_bytes.find(b'<<', pdf_bytes.find(b'trailer', xref))
+    return xref, pdf_bytes[trailer:find_dict_end(pdf_bytes, trailer)]
+
+
+def replace_catalog(catalog_start, catalog_end):
+    catalog_start = catalog_start.decode('ascii')
+    catalog_end = catalog_end.decode('ascii')
+    for catalog_part in catalog_start, catalog_end:
+        if '/PageLabels' in catalog_part:
+            raise RuntimeError(
+                f'PDF already has PageLabels in Category: {catalog_part}')
+
+    return (
+        f'''<<{catalog_start}'''
+        f'''/PageLabels'''
+        f'''<</Nums[0 << /S /r >> {introduction_page - 1} << /S /D >>]>>'''
+        f'''{catalog_end}>>'''.encode('ascii'))
+
+
+# The output PDF has one Catalog entry like:
+# 1417 0 obj
+# <</Type/Catalog/Pages 1412 0 R/Outlines 1415 0 R>>
+# Add /PageLabels before /Outlines. Rather than rewriting the whole file, make a
+# PDF incremental update: append a new version of the catalog object, an xref
+# section for it, and a trailer whose /Prev points at the previous xref. The
+# rest of the file, and its xref offsets, stay untouched. Memory-map the
+# temporary PDF so we can search it without reading it all into memory.
+with open(tmp_pdf, 'rb') as tmp_file, \
+        mmap.mmap(tmp_file.fileno(), 0, access=mmap.ACCESS_READ) as tmp_bytes:
+    catalog_start, catalog_outlines, catalog_end = find_catalog(tmp_bytes)
+    new_catalog = replace_catalog(
+        tmp_bytes[catalog_start + 2:catalog_outlines],
+        tmp_bytes[catalog_outlines:catalog_end - 2])
+
+    object_header = _OBJECT_HEADER_RE.search(
+        tmp_bytes[max(0, catalog_start - 64):catalog_start])
+    if not object_header:
+        raise RuntimeError(f"Couldn't find the /Catalog object in {tmp_pdf}")
+    catalog_number, catalog_generation = map(int, object_header.groups())
+
+    prev_xref, trailer = find_trailer(tmp_bytes)
+    tmp_size = len(tmp_bytes)
+
+# Carry /Size and the optional /Info and /ID over from the previous trailer.
+size = _TRAILER_SIZE_RE.search(trailer)
+if not size:
+    raise RuntimeError(f"No /Size in {tmp_pdf}'s trailer")
+new_trailer = b'/Size %s /Root %d %d R /Prev %d' % (
+    size.group(1), catalog_number, catalog_generation, prev_xref)
+for entry_re in _TRAILER_INFO_RE, _TRAILER_ID_RE:
+    if entry := entry_re.search(trailer):
+        new_trailer += b' ' + entry.group(0)
+
+catalog_object = b'\n%d %d obj\n%s\nendobj\n' % (
+    catalog_number, catalog_generation, new_catalog)
+with open(tmp_pdf, 'ab') as tmp_file:
+    tmp_file.write(catalog_object)
+    # Each xref entry is exactly 20 bytes, including its 2-byte line ending.
+    tmp_file.write(
+        b'xref\n%d 1\n%010d %05d n \ntrailer\n<<%s>>\nstartxref\n%d\n%%%%EOF\n'
+        % (catalog_number, tmp_size + 1, catalog_generation, new_trailer,
+           tmp_size + len(catalog_object)))
+
+os.replace(tmp_pdf, output_pdf)
 
 print(output_pdf)